@@ -8,11 +8,17 @@ Original file is located at
 """
 
 # Imports and defaults
+from collections import OrderedDict
+import copy
+import hashlib
+import json
 import joblib
 from joblib import Parallel, delayed
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
+import os
+from scipy.linalg import solve_triangular
 from scipy.linalg import sqrtm
 from scipy.optimize import linprog
 import time
@@ -50,12 +56,13 @@ def linestyle2dashes(style):
     return (None, None)
 
 # Optimal designs
-def d_grad(X, V, p, return_grad=True):
+def d_grad(X, V, p, return_grad=True, chunk_size=None):
   """Value of D-optimal objective and its gradient.
 
   X: n x d matrix of arm features
   V: prior design matrix
   p: distribution over n arms (design)
+  chunk_size: number of arms per block of the gradient (all arms if None)
   """
   n, d = X.shape
 
@@ -67,69 +74,425 @@ def d_grad(X, V, p, return_grad=True):
   # objective value (log det)
   _, obj = np.linalg.slogdet(invG)
   if return_grad:
-    # gradient of the objective
-    X2 = np.einsum("ki,kj->kij", X, X)
-    M = np.einsum("kij,jl->kil", X2, invG)
-    dp = - np.trace(M, axis1=-2, axis2=-1)
+    # gradient of the objective, - x_k^T G^{-1} x_k for all arms k
+    if chunk_size is None:
+      chunk_size = n
+    dp = np.zeros(n)
+    for start in range(0, n, chunk_size):
+      Xc = X[start : start + chunk_size, :]
+      dp[start : start + chunk_size] = - (Xc.dot(invG) * Xc).sum(axis=1)
   else:
     dp = 0
 
   return obj, dp
 
 
-def d_design(X, V=None, pi_0=None, num_iters=100, tol=1e-6, printout=True):
-  """Frank-Wolfe algorithm for d-design optimization.
+def d_line_search(G, D, w_max=1):
+  """Exact line search for the D-optimal objective.
 
-  X: n x d matrix of arm features
-  V: prior design matrix
-  pi_0: initial distribution over n arms (design)
-  num_iters: maximum number of Frank-Wolfe iterations
-  tol: stop when two consecutive objective values differ by less than tol
+  Maximizes log det(G + w D) over w in [0, w_max]. The objective equals
+  log det(G) + sum_i log(1 + w lambda_i), where lambda are the eigenvalues of
+  G^{-1/2} D G^{-1/2}, and is concave in w. When D moves the design towards a
+  single arm and V = 0, the maximizer is the closed-form step (g - d) / (d (g - 1))
+  of the matrix determinant lemma, where g is the variance of the arm.
+
+  G: d x d design matrix (positive definite), or a stack of them
+  D: d x d change of the design matrix, or a stack of them
+  w_max: maximum step size, or one per matrix in the stack
   """
-  n, d = X.shape
+  L = np.linalg.cholesky(G)
+  C = np.linalg.solve(L, np.swapaxes(np.linalg.solve(L, D), -1, -2))
+  lam = np.linalg.eigvalsh((C + np.swapaxes(C, -1, -2)) / 2)
+
+  # safeguarded Newton's method for the root of the derivative sum_i lambda_i / (1 + w lambda_i),
+  # which is decreasing in w (minus infinity where the design matrix is singular)
+  def slope(w):
+    den = 1 + w[..., np.newaxis] * lam
+    ratio = lam / np.where(den > 0, den, 1)
+    d1 = np.where(den.min(axis=-1) > 0, ratio.sum(axis=-1), -np.inf)
+    return d1, np.maximum(np.square(ratio).sum(axis=-1), 1e-300)
+
+  # steps at the boundary of [0, w_max] need no iterations
+  w_max = np.zeros(lam.shape[: -1]) + w_max
+  interior = (lam.sum(axis=-1) > 0) & (slope(w_max)[0] < 0)
+  boundary = np.where(lam.sum(axis=-1) > 0, w_max, 0)
+  lo = np.where(interior, 0, boundary)
+  hi = np.where(interior, w_max, boundary)
+  w = np.copy(lo)
+  for i in range(50):
+    d1, d2 = slope(w)
+    up = d1 > 0
+    lo = np.where(up, w, lo)
+    hi = np.where(up, hi, w)
+    w_new = w + np.where(np.isfinite(d1), d1, 0) / d2
+    w_new = np.where((w_new > lo) & (w_new < hi), w_new, (lo + hi) / 2)
+    converged = np.all(np.abs(w_new - w) <= 1e-12 * np.maximum(w_max, 1))
+    w = w_new
+    if converged:
+      break
+
+  if w.ndim == 0:
+    return float(w)
+  return w
+
+
+def fw_design(X, V, pi, num_iters, tol, printout, chunk_size=None,
+  oracle="simplex"):
+  """Frank-Wolfe algorithm for d-design optimization.
 
-  if V is None:
-    V = np.zeros((d, d))
-  V += 1e-6 * np.eye(d)  # avoiding singularity
+  With the simplex oracle, each iteration is the vertex direction step of Fedorov
+  and Wynn, towards the arm with the highest variance with an exact line search.
 
-  if pi_0 is None:
-    # initial allocation weights are 1 / n and they add up to 1
-    pi = np.ones(n) / n
-  else:
-    pi = np.copy(pi_0)
+  oracle: linear minimization oracle, "simplex" (closed form) or "linprog"
+  """
+  n, d = X.shape
 
   # initialize constraints
   A_ub_fw = np.ones((1, n))
   b_ub_fw = 1
 
+  # design matrix of the current solution
+  G = V + (X * pi[:, np.newaxis]).T.dot(X)
+
   # Frank-Wolfe iterations
   for iter in range(num_iters):
     # compute gradient at the last solution
     pi_last = np.copy(pi)
-    last_obj, grad = d_grad(X, V, pi_last)
+    last_obj, grad = d_grad(X, V, pi_last, chunk_size=chunk_size)
 
     if printout:
       print("%.4f" % last_obj, end=" ")
 
     # find a feasible LP solution in the direction of the gradient
-    result = linprog(grad, A_ub_fw, b_ub_fw, bounds=[0, 1], method="highs")
-    pi_lp = result.x
-    pi_lp = np.maximum(pi_lp, 0)
-    pi_lp /= pi_lp.sum()
+    if oracle == "simplex":
+      # the LP over the simplex is solved by the arm with the most negative gradient
+      pi_lp = np.zeros(n)
+      pi_lp[np.argmin(grad)] = 1
+    elif oracle == "linprog":
+      result = linprog(grad, A_ub_fw, b_ub_fw, bounds=[0, 1], method="highs")
+      pi_lp = result.x
+      pi_lp = np.maximum(pi_lp, 0)
+      pi_lp /= pi_lp.sum()
+    else:
+      raise Exception("Unknown linear minimization oracle in d_design.")
+
+    # duality gap certifies that the solution is tol-optimal
+    gap = grad.dot(pi_last - pi_lp)
+    if gap < tol:
+      break
+
+    support = np.flatnonzero(pi_lp)
+    if support.size == 1:
+      # exact line search towards a single arm, G + w (V + x x^T - G)
+      x = X[support[0], :]
+      G_lp = V + np.outer(x, x)
+      w = d_line_search(G, G_lp - G)
+
+      # update solution
+      pi = w * pi_lp + (1 - w) * pi_last
+      G = w * G_lp + (1 - w) * G
+    else:
+      # line search in the direction of the gradient
+      w = np.append(np.logspace(-10, 0, 21, base=2), 0)
+      pi_ = np.outer(w, pi_lp) + np.outer(1 - w, pi_last)
+      G_ = V[np.newaxis, :, :] + np.einsum("pi,ij,ik->pjk", pi_, X, X)
+      _, obj = np.linalg.slogdet(G_)
+      best = np.argmax(obj)
 
-    # line search in the direction of the gradient
-    w = np.append(np.logspace(-10, 0, 21, base=2), 0)
-    pi_ = np.outer(w, pi_lp) + np.outer(1 - w, pi_last)
-    G = V[np.newaxis, :, :] + np.einsum("pi,ij,ik->pjk", pi_, X, X)
-    _, obj = np.linalg.slogdet(G)
-    best = np.argmax(obj)
+      # update solution
+      pi = w[best] * pi_lp + (1 - w[best]) * pi_last
+      G = G_[best, :, :]
+
+  return pi
 
-    # update solution
-    pi = w[best] * pi_lp + (1 - w[best]) * pi_last
 
-    if np.abs(pi - pi_last).sum() < tol:
-      break;
-    iter += 1
+def multiplicative_design(X, V, pi, num_iters, tol, printout, chunk_size=None):
+  """Multiplicative algorithm of Titterington (1976) for d-design optimization.
+
+  All arms are reweighted at once, pi_k proportional to pi_k x_k^T G^{-1} x_k.
+  Arms with zero initial weight are never added to the design.
+  """
+  for iter in range(num_iters):
+    obj, grad = d_grad(X, V, pi, chunk_size=chunk_size)
+
+    if printout:
+      print("%.4f" % obj, end=" ")
+
+    # duality gap certifies that the solution is tol-optimal
+    if pi.dot(grad) - grad.min() < tol:
+      break
+
+    pi = - pi * grad
+    pi /= pi.sum()
+
+  return pi
+
+
+def sparse_start(X, pi):
+  """Initial design of solvers whose iterations move the weight of one arm.
+
+  From the uniform design, such solvers need about n iterations to concentrate the
+  weight on few arms. It is replaced by the uniform design on spread_arms, from
+  which the solvers add the arms that they need.
+  """
+  n, d = X.shape
+  if np.ptp(pi) > 0:
+    return pi
+  pi = np.zeros(n)
+  pi[spread_arms(X, d)] = 1
+  return pi / pi.sum()
+
+
+def pairwise_fw_design(X, V, pi, num_iters, tol, printout, chunk_size=None):
+  """Pairwise Frank-Wolfe algorithm for d-design optimization.
+
+  Each iteration moves weight from the support arm with the lowest variance to
+  the arm with the highest variance, with an exact line search. The uniform
+  initial design is replaced by a sparse one (see sparse_start).
+  """
+  pi = sparse_start(X, pi)
+  G = V + (X * pi[:, np.newaxis]).T.dot(X)
+
+  for iter in range(num_iters):
+    obj, grad = d_grad(X, V, pi, chunk_size=chunk_size)
+
+    if printout:
+      print("%.4f" % obj, end=" ")
+
+    # duality gap certifies that the solution is tol-optimal
+    best = np.argmin(grad)
+    if pi.dot(grad) - grad[best] < tol:
+      break
+
+    support = np.flatnonzero(pi)
+    worst = support[np.argmax(grad[support])]
+    if worst == best:
+      break
+
+    # exchange weight from the worst arm to the best arm
+    x_best = X[best, :]
+    x_worst = X[worst, :]
+    D = np.outer(x_best, x_best) - np.outer(x_worst, x_worst)
+    w = d_line_search(G, D, w_max=pi[worst])
+    pi[best] += w
+    pi[worst] = pi[worst] - w if w < pi[worst] else 0
+    G += w * D
+
+  return pi
+
+
+def away_fw_design(X, V, pi, num_iters, tol, printout, chunk_size=None):
+  """Away-step Frank-Wolfe algorithm for d-design optimization.
+
+  Each iteration either moves towards the arm with the highest variance or
+  away from the support arm with the lowest variance, whichever direction is
+  steeper. Away steps can drop arms from the support, which gives linear
+  convergence. The uniform initial design is replaced by a sparse one (see
+  sparse_start).
+  """
+  pi = sparse_start(X, pi)
+  G = V + (X * pi[:, np.newaxis]).T.dot(X)
+
+  for iter in range(num_iters):
+    obj, grad = d_grad(X, V, pi, chunk_size=chunk_size)
+
+    if printout:
+      print("%.4f" % obj, end=" ")
+
+    # duality gap certifies that the solution is tol-optimal
+    best = np.argmin(grad)
+    gap = pi.dot(grad) - grad[best]
+    if gap < tol:
+      break
+
+    support = np.flatnonzero(pi)
+    worst = support[np.argmax(grad[support])]
+    away_gap = grad[worst] - pi.dot(grad) if pi[worst] < 1 else 0
+
+    if gap >= away_gap:
+      # towards the best arm, G + w (V + x x^T - G)
+      x = X[best, :]
+      D = V + np.outer(x, x) - G
+      w = d_line_search(G, D)
+      pi *= 1 - w
+      pi[best] += w
+    else:
+      # away from the worst arm, G + w (G - V - x x^T)
+      x = X[worst, :]
+      D = G - V - np.outer(x, x)
+      w_max = pi[worst] / (1 - pi[worst])
+      w = d_line_search(G, D, w_max=w_max)
+      pi *= 1 + w
+      pi[worst] = pi[worst] - w if w < w_max else 0
+    G += w * D
+
+  return pi
+
+
+def warm_start(pi, mix=1e-3):
+  """Initial design for d_design from the last design on the current arms.
+
+  pi: weights of the last design on the current arms (zero for new arms)
+  mix: weight of the uniform design, so that every arm can enter the new design
+  """
+  n = pi.size
+  if pi.sum() <= 0:
+    return np.ones(n) / n
+  return (1 - mix) * pi / pi.sum() + mix / n
+
+
+# optimal design solvers that can be selected by name in d_design
+design_solvers = {
+  "fw": fw_design,
+  "multiplicative": multiplicative_design,
+  "pairwise_fw": pairwise_fw_design,
+  "away_fw": away_fw_design}
+
+
+def spread_arms(X, m):
+  """Indices of at least min(m, n) well-spread arms, which start a core set.
+
+  Up to 2 d arms are extreme in mutually orthogonal directions, as in the
+  initialization of Kumar and Yildirim (2005). The remaining arms have the
+  highest variances under the uniform design on the extreme arms.
+  """
+  n, d = X.shape
+
+  arms = []
+  R = np.copy(X)  # arm features without their components in the chosen directions
+  for i in range(d):
+    norms = np.square(R).sum(axis=1)
+    if norms.max() <= 1e-12:
+      break
+    u = R[np.argmax(norms), :] / np.sqrt(norms.max())
+    proj = X.dot(u)
+    arms += [np.argmax(proj), np.argmin(proj)]
+    R -= np.outer(R.dot(u), u)
+  arms = np.unique(arms)
+
+  if arms.size < m:
+    X_arms = X[arms, :]
+    G = X_arms.T.dot(X_arms) / arms.size + 1e-6 * np.eye(d)
+    g = (X.dot(np.linalg.inv(G)) * X).sum(axis=1)
+    g[arms] = - np.inf
+    arms = np.union1d(arms, np.argsort(- g)[: m - arms.size])
+  return arms
+
+
+def coreset_design(X, V, pi, num_iters, tol, printout, solver, coreset=None,
+  prune=True, num_rounds=10, **kwargs):
+  """D-optimal design on a core set of arms that grows as needed.
+
+  The design is optimized on the core set, which then gains the arms with the
+  highest variances outside of it, until the Frank-Wolfe duality gap over all
+  arms is less than tol. With prune=True, arms whose variance is below the
+  bound of Harman and Pronzato (2007) are dropped for good, because they cannot
+  support any D-optimal design. The bound assumes no prior design matrix, and
+  its epsilon is the duality gap, which stays positive under the 1e-6 I that
+  d_design adds. Arms in the support of the current design are never dropped.
+
+  coreset: size of the initial core set (the support of pi if None)
+  num_rounds: maximum number of times that the core set is optimized
+  """
+  n, d = X.shape
+  chunk_size = kwargs.get("chunk_size")
+  iters_per_round = max(int(np.ceil(num_iters / num_rounds)), 1)
+
+  candidates = np.arange(n)  # arms that can still support a D-optimal design
+  if coreset is None:
+    core = np.flatnonzero(pi)
+    grow = d
+  else:
+    core = spread_arms(X, coreset)
+    grow = max(coreset, d)
+  pi_core = warm_start(pi[core])
+
+  for round in range(num_rounds):
+    pi_core = design_solvers[solver](X[core, :], V, pi_core, iters_per_round, tol, printout, **kwargs)
+
+    # variances of the remaining arms under the design on the core set
+    pi = np.zeros(n)
+    pi[core] = pi_core
+    _, grad = d_grad(X[candidates, :], V, pi[candidates], chunk_size=chunk_size)
+    g = - grad
+    if g.max() - pi[candidates].dot(g) < tol or round == num_rounds - 1:
+      break
+
+    if prune:
+      # Harman and Pronzato (2007), arms below the bound are not in the support of any D-optimal design
+      eps = max(g.max() - pi[candidates].dot(g), 0)
+      bound = d * (1 + eps / 2 - np.sqrt(eps * (4 + eps - 4 / d)) / 2)
+      keep = (g >= bound) | (pi[candidates] > 0)
+      in_core = np.isin(core, candidates[keep])
+      if in_core.any():
+        candidates = candidates[keep]
+        g = g[keep]
+        core = core[in_core]
+        pi_core = pi_core[in_core]
+      else:
+        # the bound would empty the core set, which only happens by rounding
+        prune = False
+
+    # grow the core set by the arms with the highest variances outside of it
+    outside = np.flatnonzero(~np.isin(candidates, core))
+    outside = outside[np.argsort(- g[outside])[: grow]]
+    outside = outside[g[outside] > pi[candidates].dot(g)]
+    core = np.append(core, candidates[outside])
+    pi_core = warm_start(np.append(pi_core, np.zeros(outside.size)))
+
+  pi = np.zeros(n)
+  pi[core] = pi_core
+  return pi
+
+
+def d_design(X, V=None, pi_0=None, num_iters=100, tol=1e-6, printout=True,
+  solver="fw", cache=None, coreset=None, prune=False, **kwargs):
+  """D-optimal design.
+
+  X: n x d matrix of arm features
+  V: prior design matrix
+  pi_0: initial distribution over n arms (design)
+  num_iters: maximum number of iterations
+  tol: stop when the Frank-Wolfe duality gap, an upper bound on the distance
+    of log det from its optimum, is less than tol
+  solver: name of the solver in design_solvers
+  cache: DesignCache that returns the design of an identical earlier problem
+  coreset: optimize on a core set of this many well-spread arms, which grows
+    as needed (see coreset_design)
+  prune: drop arms that cannot support a D-optimal design (only without V)
+  kwargs: solver options, such as chunk_size (number of arms per block of the
+    gradient) and oracle (linear minimization oracle of "fw")
+  """
+  n, d = X.shape
+
+  if cache is not None:
+    settings = dict(kwargs)
+    if coreset is not None or prune:
+      settings.update(coreset=coreset, prune=prune)
+    key = cache.key(X, V, pi_0, num_iters=num_iters, tol=tol, solver=solver, **settings)
+    pi = cache.get(key)
+    if pi is None:
+      pi = d_design(X, V, pi_0, num_iters, tol, printout, solver, coreset=coreset, prune=prune, **kwargs)
+      cache.put(key, pi)
+    return pi
+
+  prune = prune and V is None
+  if V is None:
+    V = np.zeros((d, d))
+  V = V + 1e-6 * np.eye(d)  # avoiding singularity (without modifying the caller's V)
+
+  if pi_0 is None:
+    # initial allocation weights are 1 / n and they add up to 1
+    pi = np.ones(n) / n
+  else:
+    pi = np.copy(pi_0)
+
+  if solver not in design_solvers:
+    raise Exception("Unknown solver in d_design.")
+  if coreset is not None or prune:
+    pi = coreset_design(X, V, pi, num_iters, tol, printout, solver, coreset=coreset, prune=prune, **kwargs)
+  else:
+    pi = design_solvers[solver](X, V, pi, num_iters, tol, printout, **kwargs)
 
   if printout:
     print()
@@ -138,33 +501,304 @@ def d_design(X, V=None, pi_0=None, num_iters=100, tol=1e-6, printout=True):
   pi /= pi.sum()
   return pi
 
+
+def d_design_batch(X, V=None, mask=None, pi_0=None, num_iters=100, tol=1e-6,
+  solver="fw"):
+  """D-optimal designs of many independent problems at once.
+
+  X: B x n x d array of arm features
+  V: B x d x d array of prior design matrices
+  mask: B x n array that marks the arms of each problem (all arms if None)
+  pi_0: B x n array of initial designs
+  num_iters: maximum number of iterations
+  tol: stop a problem when its Frank-Wolfe duality gap is less than tol
+  solver: "fw" (Frank-Wolfe towards the best arm) or "multiplicative"
+  """
+  B, n, d = X.shape
+
+  if V is None:
+    V = np.zeros((B, d, d))
+  V = V + 1e-6 * np.eye(d)  # avoiding singularity (without modifying the caller's V)
+
+  if mask is None:
+    mask = np.ones((B, n), dtype=bool)
+  if pi_0 is None:
+    # initial allocation weights are uniform over the arms of each problem
+    pi = mask / mask.sum(axis=1, keepdims=True)
+  else:
+    pi = np.where(mask, pi_0, 0)
+    pi /= pi.sum(axis=1, keepdims=True)
+
+  rows = np.arange(B)
+  for iter in range(num_iters):
+    # variances x_k^T G^{-1} x_k of all arms in all problems
+    G = V + np.einsum("bk,bki,bkj->bij", pi, X, X)
+    invG = np.linalg.inv(G)
+    g = (np.matmul(X, invG) * X).sum(axis=-1)
+    g = np.where(mask, g, 0)
+
+    # duality gaps certify that the solutions are tol-optimal
+    best = np.argmax(np.where(mask, g, -np.inf), axis=1)
+    gap = g[rows, best] - (pi * g).sum(axis=1)
+    unsolved = gap >= tol
+    if not unsolved.any():
+      break
+
+    if solver == "fw":
+      # exact line search towards the best arm of each problem
+      x = X[rows, best, :]
+      G_lp = V + np.einsum("bi,bj->bij", x, x)
+      w = np.where(unsolved, d_line_search(G, G_lp - G), 0)
+      pi *= (1 - w)[:, np.newaxis]
+      pi[rows, best] += w
+    elif solver == "multiplicative":
+      pi_new = pi * g
+      pi_new /= pi_new.sum(axis=1, keepdims=True)
+      pi = np.where(unsolved[:, np.newaxis], pi_new, pi)
+    else:
+      raise Exception("Unknown solver in d_design_batch.")
+
+  pi = np.maximum(pi, 0)
+  pi /= pi.sum(axis=1, keepdims=True)
+  return pi
+
+
+class DesignCache(object):
+  """Cache of optimal designs keyed by a hash of the design problem.
+
+  Designs are kept in an in-process LRU tier of maxsize entries and, if path is
+  set, as .npy files in path that parallel workers can share.
+  """
+
+  def __init__(self, maxsize=128, path=None):
+    self.maxsize = maxsize
+    self.path = path
+    self.designs = OrderedDict()
+
+  def key(self, X, V, pi_0, **settings):
+    # hash of the arm features, prior design matrix, initial design, and solver settings
+    h = hashlib.sha1()
+    for A in [X, V, pi_0]:
+      if A is None:
+        h.update(b"None")
+      else:
+        A = np.ascontiguousarray(A)
+        h.update(("%s %s" % (A.dtype.str, A.shape)).encode())
+        h.update(A.tobytes())
+    h.update(repr(sorted(settings.items())).encode())
+    return h.hexdigest()
+
+  def get(self, key):
+    if key in self.designs:
+      self.designs.move_to_end(key)
+      return np.copy(self.designs[key])
+
+    if self.path is not None:
+      fname = os.path.join(self.path, key + ".npy")
+      if os.path.exists(fname):
+        pi = np.load(fname)
+        self.put(key, pi, write=False)
+        return np.copy(pi)
+
+    return None
+
+  def put(self, key, pi, write=True):
+    self.designs[key] = np.copy(pi)
+    self.designs.move_to_end(key)
+    while len(self.designs) > self.maxsize:
+      self.designs.popitem(last=False)
+
+    if write and self.path is not None:
+      # write to a temporary file and rename it, so that other workers never read partial files
+      os.makedirs(self.path, exist_ok=True)
+      fname = os.path.join(self.path, key + ".npy")
+      tmp_fname = "%s.%d.tmp.npy" % (fname[: -4], os.getpid())
+      np.save(tmp_fname, pi)
+      os.replace(tmp_fname, fname)
+
+
+# designs shared by all runs and algorithms in this process (set path to share them across workers)
+design_cache = DesignCache()
+
+
+class AliasSampler(object):
+  """Sampler of a fixed design by Vose's alias method, O(K) to build and O(1) per draw.
+
+  Each draw takes one uniform random number, whose integer part of u K picks a column
+  and whose fractional part picks the column or its alias. Therefore a batch of draws
+  is the same as the draws one at a time from the same generator.
+  """
+
+  def __init__(self, p):
+    self.K = p.size  # number of outcomes
+    scaled = (self.K * np.asarray(p, dtype=float) / np.sum(p)).tolist()
+    prob = [1.0] * self.K
+    alias = list(range(self.K))
+
+    small = [i for i in range(self.K) if scaled[i] < 1]
+    large = [i for i in range(self.K) if scaled[i] >= 1]
+    while small and large:
+      i = small.pop()
+      j = large.pop()
+      prob[i] = scaled[i]
+      alias[i] = j
+      scaled[j] -= 1 - scaled[i]
+      if scaled[j] < 1:
+        small.append(j)
+      else:
+        large.append(j)
+    # the remaining columns have probability one, up to rounding errors
+
+    self.prob = np.array(prob)  # probability of keeping each column
+    self.alias = np.array(alias)  # alternative outcome of each column
+
+  def draw(self, rng, size=None):
+    # one outcome, or an array of size outcomes
+    if size is None:
+      u = rng.random() * self.K
+      i = min(int(u), self.K - 1)
+      return i if u - i < self.prob[i] else self.alias[i]
+
+    u = rng.random(size) * self.K
+    i = np.minimum(u.astype(int), self.K - 1)
+    return np.where(u - i < self.prob[i], i, self.alias[i])
+
 # Bandit environments and simulator
+def splitmix64(x):
+  """Finalizer of the splitmix64 generator, a bijective hash of uint64 arrays or integers."""
+  if isinstance(x, int):
+    x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+  x = x + np.uint64(0x9E3779B97F4A7C15)
+  x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+  x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+  return x ^ (x >> np.uint64(31))
+
+
+def counter_randn(key, t, arms):
+  """Standard normal noise that is a deterministic function of (key, t, arm).
+
+  Unlike a sequential generator, the noise of any arm in any round is computed on
+  its own, from a hash of the counter and the Box-Muller transform. The arguments
+  are broadcast against each other.
+
+  key: non-negative integer that identifies the random stream, such as a run
+  t: round
+  arms: arms
+  """
+  if isinstance(arms, (int, np.integer)) and isinstance(t, (int, np.integer)) and \
+    isinstance(key, (int, np.integer)):
+    # a single value with Python integers, which is several times faster than with arrays
+    h = splitmix64(splitmix64(splitmix64(int(key)) ^ int(t)) ^ int(arms))
+    u1 = ((h >> 11) + 1) / 2 ** 53  # (0, 1]
+    u2 = (splitmix64(h) >> 11) / 2 ** 53  # [0, 1)
+    return np.sqrt(-2 * np.log(u1)) * np.cos(2 * np.pi * u2)
+
+  # 1-d arrays, since arithmetic on numpy integer scalars warns on wraparound
+  shape = np.broadcast(key, t, arms).shape
+  key, t, arms = [np.broadcast_to(v, shape).astype(np.uint64).reshape(-1) for v in (key, t, arms)]
+
+  h = splitmix64(splitmix64(splitmix64(key) ^ t) ^ arms)
+  u1 = ((h >> np.uint64(11)) + np.uint64(1)).astype(float) / 2 ** 53
+  u2 = (splitmix64(h) >> np.uint64(11)).astype(float) / 2 ** 53
+  z = np.sqrt(-2 * np.log(u1)) * np.cos(2 * np.pi * u2)
+  return z.reshape(shape)
+
+
+def noise_keys(num_exps, seed=None):
+  """Keys of the counter-based reward noise of num_exps runs, which all algorithms of an
+  experiment share, from a root seed (default is drawn from the global random state)."""
+  if seed is None:
+    seed = np.random.randint(2 ** 31)
+  return np.random.SeedSequence(seed).generate_state(num_exps, np.uint64)
+
+
+def global_rng():
+  """Random generator seeded from the global random state, so that np.random.seed applies."""
+  return np.random.default_rng(np.random.randint(2 ** 31))
+
+
 class LinBandit(object):
-  """Linear bandit."""
+  """Linear bandit.
+
+  With a seed, the reward noise of arm k in round t is counter_randn(seed, t, k),
+  and it is generated only for the arms that are queried, unless lazy is False.
+  """
 
-  def __init__(self, X, theta, sigma=0.5):
+  def __init__(self, X, theta, sigma=0.5, seed=None, lazy=True, rng=None):
     self.X = np.copy(X)  # K x d matrix of arm features
     self.K = self.X.shape[0]
     self.d = self.X.shape[1]
     self.theta = np.copy(theta)  # model parameter
     self.sigma = sigma  # reward noise
+    self.seed = seed  # key of counter-based reward noise (optional)
+    self.lazy = lazy  # noise only for the queried arms when seeded
+    self.rng = rng  # random generator of reward noise without a seed (default is the global state)
 
     self.mu = self.X.dot(self.theta)  # mean rewards of all arms
     self.best_arm = np.argmax(self.mu)  # optimal arm
 
+    self.t = -1  # round, which indexes the counter-based noise
     self.randomize()
 
+  def reset(self, t=0):
+    # rewind counter-based noise to round t, so that every algorithm sees the same rewards
+    self.t = t - 1
+
   def randomize(self):
     # generate random rewards
-    self.rt = self.mu + self.sigma * np.random.randn(self.K)
+    self.t += 1
+    if self.seed is None:
+      rng = np.random if self.rng is None else self.rng
+      self.rt = self.mu + self.sigma * rng.standard_normal(self.K)
+    elif self.lazy:
+      self.rt = None
+      self.noise = {}  # noise of the arms queried in this round
+    else:
+      self.rt = self.mu + self.sigma * counter_randn(self.seed, self.t, np.arange(self.K))
+
+  def rewards(self, arms):
+    # instantaneous rewards of the arms
+    if self.rt is not None:
+      return self.rt[arms]
+    if isinstance(arms, (int, np.integer)):
+      if arms not in self.noise:
+        self.noise[arms] = counter_randn(self.seed, self.t, arms)
+      return self.mu[arms] + self.sigma * self.noise[arms]
+    return self.mu[arms] + self.sigma * counter_randn(self.seed, self.t, arms)
 
   def reward(self, arm):
     # instantaneous reward of the arm
-    return self.rt[arm]
+    return self.rewards(arm)
+
+  def block_rewards(self, arms):
+    # rewards of arms[i] and the best arm in the i-th of the next len(arms) rounds, which
+    # advances the environment as len(arms) calls of randomize() and draws the same noise
+    num_rounds = arms.size
+    if self.seed is None:
+      rng = np.random if self.rng is None else self.rng
+      rt = self.mu + self.sigma * rng.standard_normal((num_rounds, self.K))
+      self.t += num_rounds
+      self.rt = rt[-1, :]
+      return rt[np.arange(num_rounds), arms], rt[:, self.best_arm]
+
+    rounds = self.t + 1 + np.arange(num_rounds)
+    r = self.mu[arms] + self.sigma * counter_randn(self.seed, rounds, arms)
+    r_best = self.mu[self.best_arm] + self.sigma * counter_randn(self.seed, rounds, self.best_arm)
+    self.t += num_rounds
+    if self.lazy:
+      self.rt = None
+      self.noise = {}
+    else:
+      self.rt = self.mu + self.sigma * counter_randn(self.seed, self.t, np.arange(self.K))
+    return r, r_best
 
   def regret(self, arm):
     # instantaneous regret of the arm
-    return self.rt[self.best_arm] - self.rt[arm]
+    return self.rewards(self.best_arm) - self.rewards(arm)
 
   def pregret(self, arm):
     # expected regret of the arm
@@ -174,67 +808,733 @@ class LinBandit(object):
     return "Linear bandit: %d dimensions, %d arms" % (self.d, self.K)
 
 
-def evaluate_one(Alg, params, env, n):
-  """One run of a bandit algorithm."""
+def evaluate_one(Alg, params, env, n, noise_seed=None, seed_seq=None,
+  metric_type="model_error", metric_schedule=None):
+  """One run of a bandit algorithm.
+
+  The run only records a compact Trace, from which the regret and metric are
+  computed afterwards. When the agent declares the arms of the next rounds, which do not
+  depend on their rewards, these rounds are simulated as one block, with vectorized
+  rewards and model estimates.
+
+  noise_seed: stream of counter-based reward noise if env has none (optional)
+  seed_seq: SeedSequence of the random generators of the environment and agent (optional)
+  metric_type: "model_error" or "cross_entropy"
+  metric_schedule: rounds of the metric, as in metric_rounds (default is every round)
+  """
+  if noise_seed is not None and env.seed is None:
+    # common random numbers, the reward noise depends only on the stream, round, and arm
+    env = LinBandit(env.X, env.theta, env.sigma, seed=noise_seed)
+  else:
+    # the run advances a shallow copy, and not the environment of the caller
+    env = copy.copy(env)
+  if seed_seq is not None:
+    # independent streams of the environment and the agent
+    env_seq, alg_seq = seed_seq.spawn(2)
+    env.rng = np.random.default_rng(env_seq)
+    params = dict(params, rng=np.random.default_rng(alg_seq))
+  env.reset()
+
   alg = Alg(env, n, params)
 
-  regret = np.zeros(n)
-  pulled_arms = np.zeros(n, dtype=int)
-  errors = np.zeros((n, env.K))
-  for t in range(n):
+  trace = Trace(n, env.d, metric_rounds(n, metric_schedule))
+  block_size = max(2 ** 20 // (env.K + env.d ** 2), 1)  # maximum rounds per block, which bounds its memory
+  t = 0
+  while t < n:
+    arms = alg.get_arm_block(t, min(block_size, n - t))
+    if arms is not None:
+      # the next rounds as one block
+      stop = t + arms.size
+      rewards, best_rewards = env.block_rewards(arms)
+      thetahats = alg.update_block(t, arms, rewards, trace.scheduled(stop))
+      trace.record_block(t, arms, rewards, best_rewards, thetahats)
+      t = stop
+      continue
+
     # generate state
     env.randomize()
 
     # take action and update agent
     arm = alg.get_arm(t)
-    alg.update(t, arm, env.reward(arm))
+    reward = env.reward(arm)
+    alg.update(t, arm, reward)
 
     # track performance
-    regret_at_t = env.regret(arm)
-    regret[t] += regret_at_t
-    pulled_arms[t] = arm
-    errors[t, :] = np.square(env.X.dot(alg.get_mle() - env.theta))
-    # errors[t, :] = env.X.dot(alg.get_mle())
-
-  metric = np.zeros(n)
-  future_pulls = np.zeros(env.K, dtype=int)
-  for t in range(n - 1, -1, -1):
-    future_pulls[pulled_arms[t]] += 1
-    metric[t] = errors[t, future_pulls > 0].max()
-    # metric[t] = (np.argmax(errors[t, future_pulls > 0]) != np.argmax(env.mu[future_pulls > 0]))
+    trace.record(t, arm, reward, env.reward(env.best_arm), alg)
+    t += 1
+
+  return trace.regret(), trace.metric(env, metric_type)
+
+
+def metric_rounds(n, schedule=None):
+  """Rounds in which costly metrics, such as the model error, are computed.
+
+  Round 0 is always included, so that the metric can be forward-filled to all rounds.
+
+  n: horizon
+  schedule: None for every round, an integer k >= 1 for every k-th round (also as
+    a float, such as n / 100), "log" or ("log", m) for m log-spaced rounds (100 by
+    default), or an array of rounds
+  """
+  if schedule is None:
+    rounds = np.arange(n)
+  elif isinstance(schedule, (int, float, np.integer, np.floating)):
+    if not (np.isfinite(schedule) and schedule >= 1 and schedule == np.floor(schedule)):
+      raise Exception("Unknown metric schedule %s in metric_rounds" % str(schedule))
+    rounds = np.arange(0, n, int(schedule))
+  elif isinstance(schedule, (str, tuple)):
+    if schedule == "log":
+      schedule = ("log", 100)
+    if schedule[0] != "log":
+      raise Exception("Unknown metric schedule %s in metric_rounds" % str(schedule))
+    rounds = np.geomspace(1, n, schedule[1]).astype(int) - 1
+  else:
+    rounds = np.asarray(schedule, dtype=int)
+  return np.union1d(rounds[(rounds >= 0) & (rounds < n)], [0])
+
+
+def forward_fill(values, rounds, n):
+  """Metric in all n rounds, where the value in each of the given rounds is held until
+  the next one."""
+  return values[np.searchsorted(rounds, np.arange(n), side="right") - 1]
+
+
+def model_error(env, thetahats, pulled_arms, rounds=None, chunk_size=1024):
+  """Model error in the given rounds, the maximum squared error of the model estimate
+  over the arms that are pulled in that round or later.
+
+  The arms pulled in round t or later are those whose last pull is in round t or
+  later, so the masks of a chunk of rounds are resolved at once from the last-pull
+  times. Only a chunk_size x K block of errors is stored, instead of n x K.
+
+  thetahats: model estimates after the given rounds, one per row
+  pulled_arms: arms pulled in all n rounds
+  rounds: increasing rounds of the metric (default is all n rounds)
+  chunk_size: number of rounds per block
+  """
+  n = pulled_arms.size
+  if rounds is None:
+    rounds = np.arange(n)
+  K = env.K
+  last_pull = np.full(K, -1)
+  np.maximum.at(last_pull, pulled_arms, np.arange(n))
+
+  metric = np.zeros(rounds.size)
+  errors = np.zeros((min(chunk_size, rounds.size), K))
+  for start in range(0, rounds.size, chunk_size):
+    block = np.arange(start, min(start + chunk_size, rounds.size))
+    for i, j in enumerate(block):
+      errors[i, :] = np.square(env.X.dot(thetahats[j, :] - env.theta))
+    future = last_pull[np.newaxis, :] >= rounds[block, np.newaxis]
+    metric[block] = np.where(future, errors[: block.size, :], -np.inf).max(axis=1)
+
+  return metric
+
+
+def cross_entropy(env, pulled_arms, rounds=None, window=100, chunk_size=256):
+  """Cross-entropy between the pulled arms and their exploration scores, in the given rounds.
+
+  The score of arm x in round t is log(1 + x^T Sigma_t x), where Sigma_t is the inverse
+  of 1e-3 I plus the outer products of the arms pulled before round t. The scores are
+  normalized over the arms pulled in the last window rounds, or over all arms in the
+  first window rounds. The outer products are accumulated over all rounds, a chunk at
+  a time, but Sigma_t and the scores are only computed in the given rounds.
+
+  pulled_arms: arms pulled in all n rounds
+  rounds: increasing rounds of the metric (default is all n rounds)
+  window: number of past rounds whose arms are feasible
+  chunk_size: number of rounds per block
+  """
+  n = pulled_arms.size
+  if rounds is None:
+    rounds = np.arange(n)
+  K, d = env.X.shape
+  Lambda = 1e-3 * np.eye(d)
+
+  metric = np.zeros(rounds.size)
+  for start in range(0, n, chunk_size):
+    stop = min(start + chunk_size, n)
+    x = env.X[pulled_arms[start : stop], :]
+    lo, hi = np.searchsorted(rounds, [start, stop])
+    if lo == hi:
+      # no metric in this chunk, only the sum of its outer products
+      Lambda = Lambda + x.T.dot(x)
+      continue
+    block = rounds[lo : hi]
+
+    # posterior covariances before each round of the block
+    outer = np.cumsum(x[:, :, np.newaxis] * x[:, np.newaxis, :], axis=0)
+    Lambdas = Lambda + np.concatenate((np.zeros((1, d, d)), outer[: -1, :, :]))[block - start, :, :]
+    Lambda = Lambda + outer[-1, :, :]
+    Sigmas = np.linalg.inv(Lambdas)
+    scores = np.log(1 + (np.matmul(env.X, Sigmas) * env.X).sum(axis=2))
+
+    # arms pulled in the last window rounds
+    past = block[:, np.newaxis] - window + np.arange(window)[np.newaxis, :]
+    rows, cols = np.nonzero(past >= 0)
+    feasible = np.zeros((block.size, K), dtype=bool)
+    feasible[rows, pulled_arms[past[rows, cols]]] = True
+    feasible[block <= window, :] = True
+
+    arm_scores = scores[np.arange(block.size), pulled_arms[block]]
+    metric[lo : hi] = - np.log(arm_scores / (scores * feasible).sum(axis=1))
+
+  metric[rounds == 0] = 0  # no pulls before the first round
+  return metric
+
+
+class Trace(object):
+  """Compact record of a run, from which its regret and metric are computed afterwards.
+
+  The pulled arm, its reward, and the reward of the best arm are recorded in every
+  round, and the model estimate only in the rounds of the metric schedule.
+  """
+
+  def __init__(self, n, d, rounds=None):
+    self.n = n  # horizon
+    self.rounds = np.arange(n) if rounds is None else rounds  # rounds of the metric
+    self.arms = np.zeros(n, dtype=int)  # pulled arms
+    self.rewards = np.zeros(n)  # rewards of the pulled arms
+    self.best_rewards = np.zeros(n)  # rewards of the best arm
+    self.thetahats = np.zeros((self.rounds.size, d))  # model estimates in the rounds of the metric
+    self.snapshots = 0  # number of recorded model estimates
+
+  def record(self, t, arm, reward, best_reward, alg):
+    self.arms[t] = arm
+    self.rewards[t] = reward
+    self.best_rewards[t] = best_reward
+    if self.snapshots < self.rounds.size and t == self.rounds[self.snapshots]:
+      self.thetahats[self.snapshots, :] = alg.get_mle()
+      self.snapshots += 1
+
+  def scheduled(self, stop):
+    # rounds of the metric before round stop whose model estimates are not recorded yet
+    return self.rounds[self.snapshots : np.searchsorted(self.rounds, stop)]
+
+  def record_block(self, t, arms, rewards, best_rewards, thetahats):
+    # rounds t, ..., t + len(arms) - 1, and the model estimates in the scheduled rounds
+    # among them
+    stop = t + arms.size
+    self.arms[t : stop] = arms
+    self.rewards[t : stop] = rewards
+    self.best_rewards[t : stop] = best_rewards
+    self.thetahats[self.snapshots : self.snapshots + thetahats.shape[0], :] = thetahats
+    self.snapshots += thetahats.shape[0]
+
+  def regret(self):
+    return self.best_rewards - self.rewards
+
+  def metric(self, env, metric_type="model_error"):
+    # metric in the scheduled rounds, forward-filled to all rounds
+    if metric_type == "model_error":
+      values = model_error(env, self.thetahats, self.arms, self.rounds)
+    elif metric_type == "cross_entropy":
+      values = cross_entropy(env, self.arms, self.rounds)
+    else:
+      raise Exception("Unknown metric %s in Trace.metric" % metric_type)
+    return forward_fill(values, self.rounds, self.n)
+
+
+def evaluate_lockstep(Alg, params, env, n, noise_seeds=None, seed_seq=None,
+  metric_type="model_error", metric_schedule=None):
+  """All runs of a bandit algorithm advanced together, one round at a time.
+
+  The runs are simulated by the batched counterpart of Alg in batch_algs, which
+  requires that all environments have the same number of arms and features.
+  Counter-based reward noise is the same as in evaluate_one.
+
+  noise_seeds: streams of counter-based reward noise of runs whose env has none (optional)
+  seed_seq: SeedSequence of the random generators of reward noise and agents (optional)
+  metric_type, metric_schedule: as in evaluate_one
+  """
+  if seed_seq is None:
+    seed_seq = np.random.SeedSequence(np.random.randint(2 ** 31))
+  env_seq, alg_seq = seed_seq.spawn(2)
+  env_rng = np.random.default_rng(env_seq)
+  alg = batch_algs[Alg](env, n, dict(params, rng=np.random.default_rng(alg_seq)))
+  num_exps = len(env)
+  rows = np.arange(num_exps)
+
+  mu = np.stack([env[ex].mu for ex in range(num_exps)])
+  sigma = np.array([env[ex].sigma for ex in range(num_exps)])
+  best_arms = np.array([env[ex].best_arm for ex in range(num_exps)])
+  keys = [env[ex].seed if env[ex].seed is not None or noise_seeds is None else noise_seeds[ex]
+    for ex in range(num_exps)]
+  counter_noise = all(key is not None for key in keys)
+  if counter_noise:
+    keys = np.array([int(key) for key in keys], dtype=np.uint64)
+
+  rounds = metric_rounds(n, metric_schedule)
+  traces = [Trace(n, alg.d, rounds) for ex in range(num_exps)]
+  pulled_arms = np.zeros((n, num_exps), dtype=int)
+  rewards = np.zeros((n, num_exps))
+  best_rewards = np.zeros((n, num_exps))
+  thetahats = np.zeros((rounds.size, num_exps, alg.d))
+  snapshots = 0  # number of recorded model estimates
+  for t in range(n):
+    # generate state
+    if not counter_noise:
+      rt = mu + sigma[:, np.newaxis] * env_rng.standard_normal((num_exps, alg.K))
+
+    # take actions and update agents
+    arms = alg.get_arms(t)
+    if counter_noise:
+      r = mu[rows, arms] + sigma * counter_randn(keys, t, arms)
+      r_best = mu[rows, best_arms] + sigma * counter_randn(keys, t, best_arms)
+    else:
+      r = rt[rows, arms]
+      r_best = rt[rows, best_arms]
+    alg.update(t, arms, r)
+
+    # track performance
+    pulled_arms[t, :] = arms
+    rewards[t, :] = r
+    best_rewards[t, :] = r_best
+    if snapshots < rounds.size and t == rounds[snapshots]:
+      thetahats[snapshots, :, :] = alg.get_mle()
+      snapshots += 1
+
+  regret = np.zeros((n, num_exps))
+  metric = np.zeros((n, num_exps))
+  for ex, trace in enumerate(traces):
+    trace.arms = pulled_arms[:, ex]
+    trace.rewards = rewards[:, ex]
+    trace.best_rewards = best_rewards[:, ex]
+    trace.thetahats = thetahats[:, ex, :]
+    regret[:, ex] = trace.regret()
+    metric[:, ex] = trace.metric(env[ex], metric_type)
 
   return regret, metric
 
 
-def evaluate(Alg, params, env, n=1000, printout=True):
-  """Multiple runs of a bandit algorithm."""
+def evaluate_chunk(Alg, params, envs, seed_seqs, n, noise_seeds=None, metric_type="model_error",
+  metric_schedule=None):
+  """Runs of a bandit algorithm in one worker, each with its own SeedSequence."""
+  if noise_seeds is None:
+    noise_seeds = [None] * len(envs)
+
+  start = time.time()
+  output = []
+  for env, seed_seq, noise_seed in zip(envs, seed_seqs, noise_seeds):
+    output.append(evaluate_one(Alg, params, env, n, noise_seed, seed_seq, metric_type,
+      metric_schedule))
+  return output, os.getpid(), time.time() - start
+
+
+def prepare_algs(algs, env, n, seed_seqs=None):
+  """Work shared by all runs of each algorithm, such as batched optimal designs, and the
+  root SeedSequences of their runs.
+
+  seed_seqs: root SeedSequences of the algorithms (default is drawn from the global
+    random state after the work of each algorithm, as in consecutive calls to evaluate)
+  """
+  root_seqs = []
+  for i, (Alg, params) in enumerate(algs):
+    if hasattr(Alg, "prepare"):
+      Alg.prepare(env, n, params)
+    if seed_seqs is None:
+      root_seqs.append(np.random.SeedSequence(np.random.randint(2 ** 31)))
+    else:
+      root_seqs.append(seed_seqs[i])
+  return root_seqs
+
+
+def print_utilization(busy, wall_time):
+  """Simulation time of each worker process, which is a fraction of the wall-clock time."""
+  for pid, worker_time in sorted(busy.items()):
+    print("Worker %d: %.1f seconds busy (%.0f%% utilization)" %
+      (pid, worker_time, 100 * worker_time / wall_time))
+
+
+def evaluate(Alg, params, env, n=1000, printout=True, lockstep=False,
+  n_jobs=1, blas_threads=1, chunk_size=None, common_noise=False, seed=None, noise_seed=None,
+  metric_type="model_error", metric_schedule=None, aggregate=False, quantile_samples=0):
+  """Multiple runs of a bandit algorithm.
+
+  Every run spawns its own child of a root SeedSequence, which seeds independent
+  random generators of its environment and agent. The results therefore do not
+  depend on n_jobs or chunk_size.
+
+  With common_noise, run ex of every algorithm draws its reward noise from the
+  counter-based stream noise_keys(runs, noise_seed)[ex], unless its environment has a
+  seed. All algorithms that are evaluated with the same noise_seed then see the same
+  rewards in each (run, round, arm) and their differences have much lower variance.
+  Algorithms keep their own random generators.
+
+  lockstep: simulate all runs together when Alg has a batched counterpart
+  n_jobs: number of worker processes (-1 for all cores)
+  blas_threads: BLAS threads per worker process, which prevents oversubscription
+  chunk_size: number of runs per task (default is about four tasks per worker)
+  common_noise: the same reward noise for all algorithms
+  seed: entropy of the root SeedSequence (default is drawn from the global random state)
+  noise_seed: root of the keys of the common reward noise (default is seed), which
+    common_noise requires with one of them, since a root drawn from the global random
+    state would differ between the calls of algorithms
+  metric_type: "model_error" or "cross_entropy"
+  metric_schedule: rounds of the metric, as in metric_rounds (default is every round),
+    which is held until the next scheduled round. The regret is tracked in every round.
+  aggregate: return RunningStats of the cumulative regret and metric in each round,
+    instead of n x runs arrays of the regret and metric
+  quantile_samples: number of runs sampled for quantiles in the aggregate mode
+  """
+  if common_noise and seed is None and noise_seed is None:
+    raise Exception("Common noise without a seed or noise_seed in evaluate")
+
   if printout:
     print("Evaluating %s" % Alg.print(), end="")
   start = time.time()
 
   num_exps = len(env)
-  regret = np.zeros((n, num_exps))
-  metric = np.zeros((n, num_exps))
-
-  output = Parallel(n_jobs=1)(delayed(evaluate_one)(Alg, params, env[ex], n)
-    for ex in range(num_exps))
-  for ex in range(num_exps):
-    regret[:, ex] = output[ex][0]
-    metric[:, ex] = output[ex][1]
+  if aggregate:
+    regret = RunningStats(n, quantile_samples)
+    metric = RunningStats(n, quantile_samples)
+  else:
+    regret = np.zeros((n, num_exps))
+    metric = np.zeros((n, num_exps))
+
+  root_seq, = prepare_algs([(Alg, params)], env, n,
+    None if seed is None else [np.random.SeedSequence(seed)])
+  noise_seeds = None
+  if common_noise:
+    noise_seeds = noise_keys(num_exps, seed if noise_seed is None else noise_seed)
+
+  busy = {}  # simulation time of each worker process
+  if lockstep and Alg in batch_algs and len(set(env[ex].X.shape for ex in range(num_exps))) == 1:
+    output = evaluate_lockstep(Alg, params, env, n, noise_seeds, root_seq, metric_type,
+      metric_schedule)
+    for ex in range(num_exps):
+      store_run(regret, metric, ex, (output[0][:, ex], output[1][:, ex]))
+  else:
+    seed_seqs = root_seq.spawn(num_exps)
+    n_jobs = joblib.effective_n_jobs(n_jobs)
+    if chunk_size is None:
+      chunk_size = max(num_exps // (4 * n_jobs), 1)
+    chunks = [range(ex, min(ex + chunk_size, num_exps)) for ex in range(0, num_exps, chunk_size)]
+
+    # chunks are stored as they finish, so that only a few are in memory at once
+    output = Parallel(n_jobs=n_jobs, backend="loky", inner_max_num_threads=blas_threads,
+      return_as="generator")(
+      delayed(evaluate_chunk)(Alg, params, [env[ex] for ex in chunk], [seed_seqs[ex] for ex in chunk], n,
+      None if noise_seeds is None else noise_seeds[chunk], metric_type, metric_schedule)
+      for chunk in chunks)
+
+    for chunk, (chunk_output, pid, chunk_time) in zip(chunks, output):
+      for ex, run_output in zip(chunk, chunk_output):
+        store_run(regret, metric, ex, run_output)
+      busy[pid] = busy.get(pid, 0) + chunk_time
   if printout:
     print(" %.1f seconds" % (time.time() - start))
+    if len(busy) > 1:
+      print_utilization(busy, time.time() - start)
+
+  if printout:
+    print_summary(regret, metric)
+
+  return regret, metric
+
+
+class RunningStats(object):
+  """Mean, variance, minimum, and maximum of curves over runs, which are updated as the
+  runs are added by Welford's algorithm. The memory is O(n) for any number of runs.
+
+  Quantiles are estimated from a bottom-k sample of runs, those with the smallest
+  hashes of their indices, and thus the sample does not depend on the order of runs.
+  The moments depend on it only through rounding.
+  """
+
+  def __init__(self, n, quantile_samples=0):
+    self.count = 0  # number of runs
+    self.mean = np.zeros(n)  # mean over runs
+    self.m2 = np.zeros(n)  # sum of squared deviations from the mean
+    self.min = np.full(n, np.inf)  # minimum over runs
+    self.max = np.full(n, - np.inf)  # maximum over runs
+    self.samples = np.zeros((quantile_samples, n))  # sampled runs
+    self.hashes = np.full(quantile_samples, np.inf)  # hashes of the indices of sampled runs
+
+  def add(self, x, ex):
+    # add curve x of run ex
+    self.count += 1
+    delta = x - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (x - self.mean)
+    np.minimum(self.min, x, out=self.min)
+    np.maximum(self.max, x, out=self.max)
+
+    if self.hashes.size:
+      h = splitmix64(int(ex))
+      i = np.argmax(self.hashes)
+      if h < self.hashes[i]:
+        self.hashes[i] = h
+        self.samples[i, :] = x
+
+  def std(self):
+    # standard deviation over runs, as np.std
+    return np.sqrt(self.m2 / self.count)
+
+  def sem(self):
+    # standard error of the mean
+    return self.std() / np.sqrt(self.count)
+
+  def quantile(self, q):
+    # quantiles over the sampled runs
+    return np.quantile(self.samples[: min(self.count, self.hashes.size), :], q, axis=0)
+
+
+def store_run(regret, metric, ex, run_output):
+  """Stores the regret and metric of run ex in the columns of regret and metric, or adds
+  their cumulative sums to RunningStats."""
+  if isinstance(regret, RunningStats):
+    regret.add(run_output[0].cumsum(), ex)
+    metric.add(run_output[1].cumsum(), ex)
+  else:
+    regret[:, ex] = run_output[0]
+    metric[:, ex] = run_output[1]
+
+
+def print_summary(regret, metric):
+  """Total regret and simple regret over runs, which are the columns of regret and metric,
+  or the last rounds of their RunningStats."""
+  if isinstance(regret, RunningStats):
+    for name, stats in [("Regret", regret), ("Simple regret", metric)]:
+      if stats.hashes.size:
+        median = "%.2f" % stats.quantile(0.5)[-1]
+      else:
+        median = "n/a"
+      print("%s: %.2f +/- %.2f (median: %s, max: %.2f, min: %.2f)" %
+        (name, stats.mean[-1], stats.sem()[-1], median, stats.max[-1], stats.min[-1]))
+    return
+
+  num_exps = regret.shape[1]
+  total_regret = regret.sum(axis=0)
+  total_simple_regret = metric.sum(axis=0)
+
+  print("Regret: %.2f +/- %.2f (median: %.2f, max: %.2f, min: %.2f)" %
+    (total_regret.mean(), total_regret.std() / np.sqrt(num_exps),
+    np.median(total_regret), total_regret.max(), total_regret.min()))
+  
+  print("Simple regret: %.2f +/- %.2f (median: %.2f, max: %.2f, min: %.2f)" %
+    (total_simple_regret.mean(), total_simple_regret.std() / np.sqrt(num_exps),
+    np.median(total_simple_regret), total_simple_regret.max(), total_simple_regret.min()))
+
+
+class CostModel(object):
+  """Time of one run of each algorithm, learned from earlier runs.
+
+  path: JSON file that keeps the timings across sessions (optional)
+  decay: weight of the latest timing in the running average
+  """
+
+  def __init__(self, path=None, decay=0.5):
+    self.path = path
+    self.decay = decay
+    self.times = {}  # average time of one run by algorithm, hyper-parameters, and horizon
+    if path is not None and os.path.exists(path):
+      with open(path) as f:
+        self.times = json.load(f)
+
+  @staticmethod
+  def key(Alg, params, n):
+    # array-valued hyper-parameters, such as priors, do not change the cost much
+    settings = sorted((attr, val) for attr, val in params.items() if np.isscalar(val))
+    return "%s %s %d" % (Alg.__name__, settings, n)
+
+  def predict(self, Alg, params, n):
+    key = self.key(Alg, params, n)
+    if key in self.times:
+      return self.times[key]
+
+    # the same algorithm at another horizon, where the cost is roughly linear in n
+    prefix = key[: key.rfind(" ") + 1]
+    known = [(int(k[len(prefix) :]), t) for k, t in self.times.items() if k.startswith(prefix)]
+    if known:
+      return np.mean([t * n / m for m, t in known])
+
+    # unknown algorithms are scheduled first, so that they are timed early
+    return np.inf
+
+  def update(self, Alg, params, n, run_time):
+    key = self.key(Alg, params, n)
+    if key in self.times:
+      self.times[key] = (1 - self.decay) * self.times[key] + self.decay * run_time
+    else:
+      self.times[key] = run_time
+
+  def save(self):
+    if self.path is not None:
+      tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+      with open(tmp_path, "w") as f:
+        json.dump(self.times, f, indent=2, sort_keys=True)
+      os.replace(tmp_path, self.path)
+
+
+def evaluate_task(task, Alg, params, env, seed_seq, n, noise_seed=None, metric_type="model_error",
+  metric_schedule=None):
+  """One run of evaluate_all, returned with its task since tasks finish in any order."""
+  output, pid, run_time = evaluate_chunk(Alg, params, [env], [seed_seq], n, [noise_seed],
+    metric_type, metric_schedule)
+  return task, output[0], pid, run_time
+
+
+def evaluate_all(algs, env, n=1000, printout=True, n_jobs=1, blas_threads=1,
+  cost_model=None, regret=None, metric=None, common_noise=False, seed=None,
+  metric_type="model_error", metric_schedule=None, aggregate=False, quantile_samples=0):
+  """Multiple runs of multiple bandit algorithms, scheduled as one pool of tasks.
+
+  Each (algorithm, run) pair is a task and the tasks are submitted longest first,
+  as predicted by cost_model, so that slow algorithms do not leave cores idle at the
+  end. Without a seed, the root SeedSequences of algorithms are drawn as in
+  consecutive calls to evaluate, and thus the results are the same. With common_noise,
+  the root of the keys of the reward noise is drawn once per call, after them.
+
+  algs: list of (algorithm class, hyper-parameters) pairs
+  cost_model: CostModel that orders the tasks and is updated with their timings
+  regret, metric: n x runs x algorithms arrays that are filled as tasks finish, or lists
+    of RunningStats of algorithms in the aggregate mode
+  common_noise: the same reward noise for all algorithms, as in evaluate
+  seed: entropy of the root SeedSequence, which spawns one child per algorithm, and of
+    the root of the keys of the reward noise (optional)
+  metric_type, metric_schedule, aggregate, quantile_samples: as in evaluate
+  """
+  start = time.time()
+
+  num_exps = len(env)
+  if regret is None:
+    if aggregate:
+      regret = [RunningStats(n, quantile_samples) for alg in algs]
+    else:
+      regret = np.zeros((n, num_exps, len(algs)))
+  if metric is None:
+    if aggregate:
+      metric = [RunningStats(n, quantile_samples) for alg in algs]
+    else:
+      metric = np.zeros((n, num_exps, len(algs)))
+  # results of each algorithm
+  if aggregate:
+    alg_regret, alg_metric = regret, metric
+  else:
+    alg_regret = [regret[:, :, i] for i in range(len(algs))]
+    alg_metric = [metric[:, :, i] for i in range(len(algs))]
+  if cost_model is None:
+    cost_model = CostModel()
+
+  root_seqs = prepare_algs(algs, env, n,
+    None if seed is None else np.random.SeedSequence(seed).spawn(len(algs)))
+  seed_seqs = [root_seq.spawn(num_exps) for root_seq in root_seqs]
+  noise_seeds = noise_keys(num_exps, seed) if common_noise else None
+
+  # longest predicted tasks first, ties broken by the order of algorithms and runs
+  costs = [cost_model.predict(Alg, params, n) for Alg, params in algs]
+  tasks = sorted([(i, ex) for i in range(len(algs)) for ex in range(num_exps)],
+    key=lambda task: -costs[task[0]])
+
+  output = Parallel(n_jobs=n_jobs, backend="loky", inner_max_num_threads=blas_threads,
+    return_as="generator_unordered")(
+    delayed(evaluate_task)((i, ex), algs[i][0], algs[i][1], env[ex], seed_seqs[i][ex], n,
+    noise_seeds[ex] if common_noise else None, metric_type, metric_schedule)
+    for i, ex in tasks)
+
+  busy = {}  # simulation time of each worker process
+  for (i, ex), run_output, pid, run_time in output:
+    store_run(alg_regret[i], alg_metric[i], ex, run_output)
+    cost_model.update(algs[i][0], algs[i][1], n, run_time)
+    busy[pid] = busy.get(pid, 0) + run_time
+  cost_model.save()
 
   if printout:
-    total_regret = regret.sum(axis=0)
-    total_simple_regret = metric.sum(axis=0)
+    wall_time = time.time() - start
+    print("Evaluated %d runs of %d algorithms in %.1f seconds" % (num_exps, len(algs), wall_time))
+    print_utilization(busy, wall_time)
+    for i, (Alg, params) in enumerate(algs):
+      print(Alg.print())
+      print_summary(alg_regret[i], alg_metric[i])
+
+  return regret, metric
+
+def evaluate_until(algs, env, n=1000, target_se=1.0, min_runs=5, batch_size=None,
+  printout=True, n_jobs=1, blas_threads=1, cost_model=None, common_noise=False, seed=None,
+  metric_type="model_error", metric_schedule=None, quantile_samples=0):
+  """Runs of multiple bandit algorithms, launched in batches until the standard errors of
+  their total regret and total metric are below target_se, or all environments are used.
 
-    print("Regret: %.2f +/- %.2f (median: %.2f, max: %.2f, min: %.2f)" %
-      (total_regret.mean(), total_regret.std() / np.sqrt(num_exps),
-      np.median(total_regret), total_regret.max(), total_regret.min()))
-    
-    print("Simple regret: %.2f +/- %.2f (median: %.2f, max: %.2f, min: %.2f)" %
-      (total_simple_regret.mean(), total_simple_regret.std() / np.sqrt(num_exps),
-      np.median(total_simple_regret), total_simple_regret.max(), total_simple_regret.min()))
+  Run ex of each algorithm is in environment ex, and its random generators and reward
+  noise are those of run ex in evaluate_all. Each batch goes to the algorithms that are
+  predicted to need the most runs, (std / target_se)^2 minus their runs so far, and
+  thus most runs are spent on the algorithms with the highest variance.
+
+  env: environments of at most len(env) runs per algorithm
+  target_se: target standard error of the total regret and metric, or a pair of them
+  min_runs: runs of each algorithm before its standard errors are estimated
+  batch_size: runs per batch (default is two per worker)
+  other arguments: as in evaluate_all
+
+  Returns lists of RunningStats of the cumulative regret and metric of algorithms.
+  """
+  start = time.time()
+
+  max_runs = len(env)
+  target = np.broadcast_to(np.asarray(target_se, dtype=float), (2,))
+  n_jobs = joblib.effective_n_jobs(n_jobs)
+  if batch_size is None:
+    batch_size = 2 * n_jobs
+  if cost_model is None:
+    cost_model = CostModel()
+
+  regret = [RunningStats(n, quantile_samples) for alg in algs]
+  metric = [RunningStats(n, quantile_samples) for alg in algs]
+
+  root_seqs = prepare_algs(algs, env, n,
+    None if seed is None else np.random.SeedSequence(seed).spawn(len(algs)))
+  noise_seeds = noise_keys(max_runs, seed) if common_noise else None
+  seed_seqs = [[] for alg in algs]  # children of root SeedSequences, spawned as needed
+  costs = [cost_model.predict(Alg, params, n) for Alg, params in algs]
+
+  runs = np.zeros(len(algs), dtype=int)  # finished runs of each algorithm
+  busy = {}  # simulation time of each worker process
+  with Parallel(n_jobs=n_jobs, backend="loky", inner_max_num_threads=blas_threads,
+    return_as="generator_unordered") as parallel:
+    while True:
+      # predicted number of additional runs of each algorithm
+      need = np.zeros(len(algs), dtype=int)
+      for i in range(len(algs)):
+        if runs[i] < min_runs:
+          need[i] = min_runs - runs[i]
+        else:
+          std = np.array([regret[i].std()[-1], metric[i].std()[-1]])
+          need[i] = np.ceil(np.square(std / target).max()) - runs[i]
+      need = np.clip(need, 0, max_runs - runs)
+      if need.sum() == 0:
+        break
+
+      # the batch is split in proportion to the needs
+      batch = np.minimum(np.ceil(batch_size * need / need.sum()), need).astype(int)
+      tasks = []
+      for i in range(len(algs)):
+        seed_seqs[i] += root_seqs[i].spawn(batch[i])
+        tasks += [(i, ex) for ex in range(runs[i], runs[i] + batch[i])]
+      tasks.sort(key=lambda task: -costs[task[0]])
+
+      output = parallel(
+        delayed(evaluate_task)((i, ex), algs[i][0], algs[i][1], env[ex], seed_seqs[i][ex], n,
+        noise_seeds[ex] if common_noise else None, metric_type, metric_schedule)
+        for i, ex in tasks)
+      for (i, ex), run_output, pid, run_time in output:
+        store_run(regret[i], metric[i], ex, run_output)
+        cost_model.update(algs[i][0], algs[i][1], n, run_time)
+        busy[pid] = busy.get(pid, 0) + run_time
+      runs += batch
+
+      if printout:
+        print("%d runs in %.1f seconds, standard errors: %s" % (runs.sum(), time.time() - start,
+          ", ".join("%.2f/%.2f" % (regret[i].sem()[-1], metric[i].sem()[-1]) for i in range(len(algs)))))
+  cost_model.save()
+
+  if printout:
+    wall_time = time.time() - start
+    print("Evaluated %d runs of %d algorithms in %.1f seconds" % (runs.sum(), len(algs), wall_time))
+    print_utilization(busy, wall_time)
+    for i, (Alg, params) in enumerate(algs):
+      print("%s (%d runs)" % (Alg.print(), runs[i]))
+      print_summary(regret[i], metric[i])
 
   return regret, metric
 
@@ -248,6 +1548,9 @@ class LinBanditAlg:
     self.theta0 = np.zeros(self.d)  # prior mean of the model parameter
     self.Sigma0 = np.eye(self.d)  # prior covariance of the model parameter
     self.sigma = 0.5  # reward noise
+    self.refactor_every = 100  # rounds between exact recomputations of the posterior
+    self.rng = None  # random generator of the agent (default is seeded from the global state)
+    self.fast_forward = True  # simulate blocks of rounds whose arms do not depend on rewards
 
     # override default values
     for attr, val in params.items():
@@ -256,9 +1559,33 @@ class LinBanditAlg:
       else:
         setattr(self, attr, val)
 
+    if self.rng is None:
+      self.rng = global_rng()
+    self.init_statistics()
+
+  def init_statistics(self):
     # sufficient statistics
     self.Lambda = np.linalg.inv(self.Sigma0)
     self.B = self.Lambda.dot(self.theta0)
+    self.refactor()
+
+  def refactor(self):
+    # linear model posterior from scratch, which removes the drift of rank-one updates
+    Sigmahat = np.linalg.inv(self.Lambda)
+    self.Sigmahat = (Sigmahat + Sigmahat.T) / 2
+    self.thetahat = self.Sigmahat.dot(self.B)
+    self.num_updates = 0
+
+    # per-arm posterior variances are recomputed on the next request
+    self.arm_var = None
+    self.arm_var_X = None
+
+  def get_arm_var(self):
+    # posterior variances x^T Sigmahat x of all arms, maintained by update()
+    if self.arm_var is None or self.arm_var_X is not self.env.X:
+      self.arm_var = (self.env.X.dot(self.Sigmahat) * self.env.X).sum(axis=1)
+      self.arm_var_X = self.env.X
+    return self.arm_var
 
   def update(self, t, arm, r):
     # update sufficient statistics
@@ -266,18 +1593,95 @@ class LinBanditAlg:
     self.Lambda += np.outer(x, x) / np.square(self.sigma)
     self.B += x * r / np.square(self.sigma)
 
+    # Sherman-Morrison update of the linear model posterior
+    self.num_updates += 1
+    if self.num_updates >= self.refactor_every:
+      self.refactor()
+    else:
+      u = self.Sigmahat.dot(x)
+      s = np.square(self.sigma) + x.dot(u)
+      self.thetahat += u * (r - x.dot(self.thetahat)) / s
+      self.Sigmahat -= np.outer(u, u) / s
+
+      # O(K d) update of the per-arm variances from projections on Sigmahat x
+      if self.arm_var_X is self.env.X:
+        self.arm_var -= np.square(self.env.X.dot(u)) / s
+
+  def get_arm_block(self, t, max_rounds):
+    # arms pulled in rounds t, t + 1, ..., at most max_rounds of them, when they do not
+    # depend on the rewards, and None otherwise
+    return None
+
+  def update_block(self, t, arms, rewards, rounds):
+    # update with arms pulled in rounds t, ..., t + len(arms) - 1, which returns the model
+    # estimates after the given rounds among them
+    X = self.env.X
+    if not rounds.size:
+      thetahats = np.zeros((0, self.d))
+    elif (arms == arms[0]).all():
+      # Sherman-Morrison formula for k pulls of one arm, Lambda + k x x^T / sigma^2
+      x = X[arms[0], :]
+      u = self.Sigmahat.dot(x)
+      k = rounds - t + 1
+      S = np.cumsum(rewards)[rounds - t]
+      thetahats = self.thetahat + np.outer((S - k * x.dot(self.thetahat)) /
+        (np.square(self.sigma) + k * x.dot(u)), u)
+    else:
+      # posteriors after the given rounds, from cumulative sums of the block
+      last = rounds[-1] - t + 1
+      x = X[arms[: last], :]
+      Lambdas = self.Lambda + np.cumsum(x[:, :, np.newaxis] * x[:, np.newaxis, :], axis=0)[rounds - t, :, :] / \
+        np.square(self.sigma)
+      Bs = self.B + np.cumsum(x * rewards[: last, np.newaxis], axis=0)[rounds - t, :] / np.square(self.sigma)
+      thetahats = np.linalg.solve(Lambdas, Bs[:, :, np.newaxis])[:, :, 0]
+
+    # sufficient statistics from pull counts, X^T diag(counts) X
+    counts = np.bincount(arms, minlength=self.K)
+    self.Lambda += (X.T * counts).dot(X) / np.square(self.sigma)
+    self.B += X.T.dot(np.bincount(arms, weights=rewards, minlength=self.K)) / np.square(self.sigma)
+    self.refactor()
+    return thetahats
+
   def get_mle(self):
-    thetahat = np.linalg.solve(self.Lambda, self.B)
-    return thetahat
+    return np.copy(self.thetahat)
+
+def chol_update(L, x):
+  """Rank-one update of a lower Cholesky factor, L L^T + x x^T, in place."""
+  x = np.copy(x)
+  for k in range(x.size):
+    r = np.sqrt(np.square(L[k, k]) + np.square(x[k]))
+    c = r / L[k, k]
+    s = x[k] / L[k, k]
+    L[k, k] = r
+    L[k + 1 :, k] = (L[k + 1 :, k] + s * x[k + 1 :]) / c
+    x[k + 1 :] = c * x[k + 1 :] - s * L[k + 1 :, k]
+
 
 class LinTS(LinBanditAlg):
-  def get_arm(self, t):
-    # linear model posterior
-    Sigmahat = np.linalg.inv(self.Lambda)
-    thetahat = Sigmahat.dot(self.B)
+  # dimension above which the factor is updated in O(d^2), since the Python loop of
+  # chol_update is slower than re-factorization by LAPACK in O(d^3) below it
+  chol_update_d = 400
+
+  def refactor(self):
+    LinBanditAlg.refactor(self)
 
-    # posterior sampling
-    thetatilde = np.random.multivariate_normal(thetahat, Sigmahat)
+    # Cholesky factor of the posterior precision, Lambda = L L^T
+    self.L = np.linalg.cholesky(self.Lambda)
+
+  def update(self, t, arm, r):
+    LinBanditAlg.update(self, t, arm, r)
+
+    if self.num_updates:  # the factor was not just recomputed by refactor()
+      if self.d > self.chol_update_d:
+        chol_update(self.L, self.env.X[arm, :] / self.sigma)
+      else:
+        self.L = np.linalg.cholesky(self.Lambda)
+
+  def get_arm(self, t):
+    # posterior sampling, thetatilde = thetahat + L^{-T} z has covariance Lambda^{-1}
+    z = self.rng.standard_normal(self.d)
+    thetatilde = self.thetahat + solve_triangular(self.L, z, lower=True, trans="T",
+      check_finite=False)
     self.mu = self.env.X.dot(thetatilde)
 
     arm = np.argmax(self.mu)
@@ -307,14 +1711,9 @@ class LinUCB(LinBanditAlg):
     return width
 
   def get_arm(self, t):
-    # linear model posterior
-    Sigmahat = np.linalg.inv(self.Lambda)
-    thetahat = Sigmahat.dot(self.B)
-
     # UCBs
-    invV = Sigmahat / np.square(self.sigma)  # V^{-1} = posterior covariance / \sigma^2
-    self.mu = self.env.X.dot(thetahat) + self.cew * \
-      np.sqrt((self.env.X.dot(invV) * self.env.X).sum(axis=1))
+    var = np.maximum(self.get_arm_var(), 0) / np.square(self.sigma)  # x^T V^{-1} x, where V^{-1} = posterior covariance / \sigma^2
+    self.mu = self.env.X.dot(self.thetahat) + self.cew * np.sqrt(var)
 
     arm = np.argmax(self.mu)
     return arm
@@ -333,11 +1732,10 @@ class LinGreedy(LinBanditAlg):
   def get_arm(self, t):
     self.mu = np.zeros(self.K)
 
-    if np.random.rand() < self.epsilon * np.sqrt(self.n / (t + 1)) / 2:
-      self.mu[np.random.randint(self.K)] = np.Inf
+    if self.rng.random() < self.epsilon * np.sqrt(self.n / (t + 1)) / 2:
+      self.mu[self.rng.integers(self.K)] = np.Inf
     else:
-      theta = np.linalg.solve(self.Lambda, self.B)
-      self.mu = self.env.X.dot(theta)
+      self.mu = self.env.X.dot(self.thetahat)
 
     arm = np.argmax(self.mu)
     return arm
@@ -357,15 +1755,21 @@ class LinExploreCommit(LinBanditAlg):
     self.mu = np.zeros(self.K)
 
     if t <= np.round(self.epsilon * self.n):
-      self.mu[np.random.randint(self.K)] = np.Inf
+      self.mu[self.rng.integers(self.K)] = np.Inf
       if t == np.round(self.epsilon * self.n):
-        self.theta = np.linalg.solve(self.Lambda, self.B)
+        self.theta = np.copy(self.thetahat)
     else:
       self.mu = self.env.X.dot(self.theta)
 
     arm = np.argmax(self.mu)
     return arm
 
+  def get_arm_block(self, t, max_rounds):
+    # the committed arm until the horizon
+    if self.fast_forward and t > np.round(self.epsilon * self.n):
+      return np.full(max_rounds, np.argmax(self.env.X.dot(self.theta)))
+    return None
+
   @staticmethod
   def print():
     return "Linear explore-then-commit"
@@ -375,6 +1779,7 @@ class LinPhasedElim(LinBanditAlg):
   def __init__(self, env, n, params):
     self.delta = 0.05  # confidence interval failure probability
     self.reset_statistics = True
+    self.design_solver = "fw"  # name of the solver in design_solvers
 
     LinBanditAlg.__init__(self, env, n, params)
 
@@ -385,20 +1790,36 @@ class LinPhasedElim(LinBanditAlg):
       np.log(self.K * ell * (ell + 1) / self.delta)))
     self.active_arms = np.arange(self.K)
 
-    # optimal design
-    self.pi = d_design(self.env.X, num_iters=100, printout=False)
+    # optimal design and its sampler, which is rebuilt only when the design changes
+    self.pi = d_design(self.env.X, num_iters=100, printout=False,
+      solver=self.design_solver, cache=design_cache)
+    self.sampler = AliasSampler(self.pi)
+
+  @staticmethod
+  def prepare(envs, n, params):
+    # solve the initial designs of all runs as one batch, which __init__ then finds in design_cache
+    solver = params.get("design_solver", "fw")
+    if solver not in ["fw", "multiplicative"] or len(set(env.X.shape for env in envs)) > 1:
+      return
+
+    problems = OrderedDict()
+    for env in envs:
+      key = design_cache.key(env.X, None, None, num_iters=100, tol=1e-6, solver=solver)
+      if key not in problems and design_cache.get(key) is None:
+        problems[key] = env.X
+    if problems:
+      pi = d_design_batch(np.stack(list(problems.values())), num_iters=100, tol=1e-6, solver=solver)
+      for i, key in enumerate(problems):
+        design_cache.put(key, pi[i, :])
 
   def get_arm(self, t):
     if not self.remaining_rounds:
-      # linear model posterior
-      Sigmahat = np.linalg.inv(self.Lambda)
-      thetahat = Sigmahat.dot(self.B)
-
       # elimination
       ci = np.power(0.5, self.phase + 1)
-      UCB = self.env.X.dot(thetahat) + ci
-      LCB = self.env.X.dot(thetahat) - ci
-      self.active_arms = self.active_arms[UCB[self.active_arms] > LCB[self.active_arms].max()]
+      UCB = self.env.X.dot(self.thetahat) + ci
+      LCB = self.env.X.dot(self.thetahat) - ci
+      survivors = UCB[self.active_arms] > LCB[self.active_arms].max()
+      self.active_arms = self.active_arms[survivors]
 
       # initialize a new phase
       self.phase += 1
@@ -407,22 +1828,35 @@ class LinPhasedElim(LinBanditAlg):
         np.log(self.K * ell * (ell + 1) / self.delta)))
 
       if self.reset_statistics:
-        # sufficient statistics
-        self.Lambda = np.linalg.inv(self.Sigma0)
-        self.B = self.Lambda.dot(self.theta0)
+        self.init_statistics()
 
-      # optimal design
+      # optimal design, which is unchanged when no arm is eliminated
       if self.active_arms.size > 1:
-        self.pi = d_design(self.env.X[self.active_arms, :], num_iters=100, printout=False)
-        self.pi /= self.pi.sum()
+        if not survivors.all():
+          # warm start from the last design on the surviving arms
+          pi_0 = warm_start(self.pi[survivors])
+          self.pi = d_design(self.env.X[self.active_arms, :], pi_0=pi_0, num_iters=100,
+            printout=False, solver=self.design_solver, cache=design_cache)
+          self.pi /= self.pi.sum()
+          self.sampler = AliasSampler(self.pi)
       else:
         self.pi = np.ones(1)
+        self.sampler = AliasSampler(self.pi)
     else:
       self.remaining_rounds -= 1
 
-    arm = np.random.choice(self.active_arms, p=self.pi)
+    arm = self.active_arms[self.sampler.draw(self.rng)]
     return arm
 
+  def get_arm_block(self, t, max_rounds):
+    # arms until the end of the phase, sampled from the design by one batch that draws the
+    # same arms as the calls in get_arm
+    if self.fast_forward and self.remaining_rounds:
+      num_rounds = min(self.remaining_rounds, max_rounds)
+      self.remaining_rounds -= num_rounds
+      return self.active_arms[self.sampler.draw(self.rng, num_rounds)]
+    return None
+
   @staticmethod
   def print():
     return "Linear phased elimination"
@@ -432,9 +1866,14 @@ class CODE(LinBanditAlg):
   def __init__(self, env, n, params):
     self.acquisition = "policy"
     self.delta = 0.05  # confidence interval failure probability
+    self.design_solver = "fw"  # name of the solver in design_solvers
+    self.design_rtol = 1e-2  # reuse the last design while Lambda changes relatively less than this
 
     LinBanditAlg.__init__(self, env, n, params)
     self.L = 1
+
+    # last D-optimal design over all arms, and the arms and Lambda it was computed for
+    self.design = None
     self.prior_effect = 1e5 * np.square(self.sigma)  # V = \sigma^2 (posterior covariance)^{-1}
 
   def confidence_ellipsoid_width(self, t):
@@ -447,30 +1886,23 @@ class CODE(LinBanditAlg):
     return width
 
   def get_arm(self, t):
-    # linear model posterior
-    Sigmahat = np.linalg.inv(self.Lambda)
-    thetahat = Sigmahat.dot(self.B)
-
     # elimination
     cew = self.confidence_ellipsoid_width(t)
-    invV = Sigmahat / np.square(self.sigma)  # V^{-1} = posterior covariance / \sigma^2
-    ci = cew * np.sqrt((self.env.X.dot(invV) * self.env.X).sum(axis=1))
-    UCB = self.env.X.dot(thetahat) + ci
-    LCB = self.env.X.dot(thetahat) - ci
+    var = np.maximum(self.get_arm_var(), 0) / np.square(self.sigma)  # x^T V^{-1} x, where V^{-1} = posterior covariance / \sigma^2
+    ci = cew * np.sqrt(var)
+    UCB = self.env.X.dot(self.thetahat) + ci
+    LCB = self.env.X.dot(self.thetahat) - ci
     self.active_arms = np.flatnonzero(UCB > LCB.max())
 
     if self.acquisition == "action":
       # maximum variance action
-      X_active = self.env.X[self.active_arms, :]
-      var = np.einsum("ij,jk,ik->i", X_active, Sigmahat, X_active)
-      best = np.argmax(var)
+      best = np.argmax(self.get_arm_var()[self.active_arms])
       arm = self.active_arms[best]
     elif self.acquisition == "policy":
       if self.active_arms.size > 1:
         # minimum D-optimal design policy
-        num_iters = 2 * self.d
-        pi = d_design(self.env.X[self.active_arms, :], self.Lambda, num_iters=num_iters, tol=1e-4, printout=False)
-        best = np.random.choice(self.active_arms.size, p=pi)
+        self.get_design()
+        best = self.sampler.draw(self.rng)
         arm = self.active_arms[best]
       else:
         arm = self.active_arms[0]
@@ -479,10 +1911,175 @@ class CODE(LinBanditAlg):
 
     return arm
 
+  def get_design(self):
+    # D-optimal design over the active arms, warm-started from the last design, and its
+    # sampler in self.sampler, which is reused with the design
+    pi_0 = None
+    if self.design is not None and self.design[0] is self.env.X:
+      _, last_arms, last_Lambda, last_pi = self.design
+      if np.array_equal(last_arms, self.active_arms) and np.linalg.norm(self.Lambda - last_Lambda) <= \
+        self.design_rtol * np.linalg.norm(last_Lambda):
+        return last_pi[self.active_arms]
+      pi_0 = warm_start(last_pi[self.active_arms])
+
+    num_iters = 2 * self.d
+    pi = d_design(self.env.X[self.active_arms, :], self.Lambda, pi_0=pi_0, num_iters=num_iters, tol=1e-4,
+      printout=False, solver=self.design_solver)
+
+    last_pi = np.zeros(self.K)
+    last_pi[self.active_arms] = pi
+    self.design = (self.env.X, self.active_arms, np.copy(self.Lambda), last_pi)
+    self.sampler = AliasSampler(pi)
+    return pi
+
   @staticmethod
   def print():
     return "CODE"
 
+# Batched bandit algorithms, which advance many runs in lockstep
+class LinBanditAlgBatch:
+  """Runs of a linear bandit algorithm on R environments with stacked statistics.
+
+  Arm features are stored as R x K x d, Lambda and Sigmahat as R x d x d, and B and
+  thetahat as R x d. Arms and rewards are passed as vectors with one entry per run.
+  """
+  def __init__(self, envs, n, params):
+    self.envs = envs  # bandit environments of all runs
+    self.X = np.stack([env.X for env in envs])  # R x K x d arm features
+    self.R, self.K, self.d = self.X.shape  # number of runs, arms, and features
+    self.n = n  # horizon
+    self.theta0 = np.zeros(self.d)  # prior mean of the model parameter
+    self.Sigma0 = np.eye(self.d)  # prior covariance of the model parameter
+    self.sigma = 0.5  # reward noise
+    self.refactor_every = 100  # rounds between exact recomputations of the posterior
+    self.rng = None  # random generator of the agents (default is seeded from the global state)
+
+    # override default values
+    for attr, val in params.items():
+      if isinstance(val, np.ndarray):
+        setattr(self, attr, np.copy(val))
+      else:
+        setattr(self, attr, val)
+
+    if self.rng is None:
+      self.rng = global_rng()
+    self.rows = np.arange(self.R)
+    self.init_statistics()
+
+  def init_statistics(self):
+    # sufficient statistics
+    self.Lambda = np.tile(np.linalg.inv(self.Sigma0), (self.R, 1, 1))
+    self.B = self.Lambda.dot(self.theta0)
+    self.refactor()
+
+  def refactor(self):
+    # linear model posteriors and per-arm posterior variances from scratch
+    Sigmahat = np.linalg.inv(self.Lambda)
+    self.Sigmahat = (Sigmahat + np.swapaxes(Sigmahat, 1, 2)) / 2
+    self.thetahat = np.einsum("rij,rj->ri", self.Sigmahat, self.B)
+    self.arm_var = (np.matmul(self.X, self.Sigmahat) * self.X).sum(axis=-1)
+    self.num_updates = 0
+
+  def update(self, t, arms, r):
+    # update sufficient statistics
+    x = self.X[self.rows, arms, :]
+    self.Lambda += np.einsum("ri,rj->rij", x, x) / np.square(self.sigma)
+    self.B += x * r[:, np.newaxis] / np.square(self.sigma)
+
+    # Sherman-Morrison updates of the linear model posteriors
+    self.num_updates += 1
+    if self.num_updates >= self.refactor_every:
+      self.refactor()
+    else:
+      u = np.einsum("rij,rj->ri", self.Sigmahat, x)
+      s = np.square(self.sigma) + (x * u).sum(axis=1)
+      self.thetahat += u * ((r - (x * self.thetahat).sum(axis=1)) / s)[:, np.newaxis]
+      self.Sigmahat -= np.einsum("ri,rj->rij", u, u) / s[:, np.newaxis, np.newaxis]
+      self.arm_var -= np.square(np.einsum("rkj,rj->rk", self.X, u)) / s[:, np.newaxis]
+
+  def get_mle(self):
+    return np.copy(self.thetahat)
+
+
+class LinTSBatch(LinBanditAlgBatch):
+  def get_arms(self, t):
+    # posterior sampling, thetatilde = thetahat + L^{-T} z has covariance Lambda^{-1}
+    L = np.linalg.cholesky(self.Lambda)
+    z = self.rng.standard_normal((self.R, self.d))
+    thetatilde = self.thetahat + np.linalg.solve(np.swapaxes(L, 1, 2), z[:, :, np.newaxis])[:, :, 0]
+    self.mu = np.einsum("rkj,rj->rk", self.X, thetatilde)
+
+    arms = np.argmax(self.mu, axis=1)
+    return arms
+
+
+class LinUCBBatch(LinBanditAlgBatch):
+  def __init__(self, envs, n, params):
+    LinBanditAlgBatch.__init__(self, envs, n, params)
+
+    self.cew = self.confidence_ellipsoid_width(n)
+
+  def confidence_ellipsoid_width(self, t):
+    # Theorem 2 in Abassi-Yadkori (2011), one width per run as in LinUCB
+    delta = 1 / self.n
+    L = np.amax(np.linalg.norm(self.X, axis=2), axis=1)
+    Lambda = np.square(self.sigma) * np.linalg.eigvalsh(np.linalg.inv(self.Sigma0)).max()
+    R = self.sigma
+    S = np.sqrt(self.d)
+    width = np.sqrt(Lambda) * S + \
+      R * np.sqrt(self.d * np.log((1 + t * np.square(L) / Lambda) / delta))
+    return width
+
+  def get_arms(self, t):
+    # UCBs
+    var = np.maximum(self.arm_var, 0) / np.square(self.sigma)
+    self.mu = np.einsum("rkj,rj->rk", self.X, self.thetahat) + \
+      self.cew[:, np.newaxis] * np.sqrt(var)
+
+    arms = np.argmax(self.mu, axis=1)
+    return arms
+
+
+class LinGreedyBatch(LinBanditAlgBatch):
+  def __init__(self, envs, n, params):
+    self.epsilon = 0.05
+
+    LinBanditAlgBatch.__init__(self, envs, n, params)
+
+  def get_arms(self, t):
+    explore = self.rng.random(self.R) < self.epsilon * np.sqrt(self.n / (t + 1)) / 2
+    self.mu = np.einsum("rkj,rj->rk", self.X, self.thetahat)
+
+    arms = np.where(explore, self.rng.integers(self.K, size=self.R), np.argmax(self.mu, axis=1))
+    return arms
+
+
+class LinExploreCommitBatch(LinBanditAlgBatch):
+  def __init__(self, envs, n, params):
+    self.epsilon = 0.05
+
+    LinBanditAlgBatch.__init__(self, envs, n, params)
+
+  def get_arms(self, t):
+    if t <= np.round(self.epsilon * self.n):
+      arms = self.rng.integers(self.K, size=self.R)
+      if t == np.round(self.epsilon * self.n):
+        self.theta = np.copy(self.thetahat)
+    else:
+      self.mu = np.einsum("rkj,rj->rk", self.X, self.theta)
+      arms = np.argmax(self.mu, axis=1)
+
+    return arms
+
+
+# batched counterparts of bandit algorithms, used by evaluate(..., lockstep=True)
+batch_algs = {
+  LinTS: LinTSBatch,
+  LinUCB: LinUCBBatch,
+  LinGreedy: LinGreedyBatch,
+  LinExploreCommit: LinExploreCommitBatch}
+
+
 def generate_bandits(num_runs, theta0, Sigma0):
   envs = []
   for run in range(num_runs):
@@ -526,13 +2123,14 @@ regret_algs = np.zeros((n, num_runs, len(algs)))
 simple_regret_algs = np.zeros((n, num_runs, len(algs)))
 
 # simulation
-for alg in algs:
-  # all runs for a single algorithm
-  alg_class = globals()[alg[0]]
-  regret, simple_regret = evaluate(alg_class, alg[1], envs, n)
+# all runs of all algorithms, scheduled longest first on all cores and with common reward noise
+cost_model = CostModel(path="data/cost_model_linear.json")
+evaluate_all([(globals()[alg[0]], alg[1]) for alg in algs], envs, n, n_jobs=-1,
+  cost_model=cost_model, regret=regret_algs, metric=simple_regret_algs, common_noise=True)
 
-  regret_algs[:, :, algs.index(alg)] = regret
-  simple_regret_algs[:, :, algs.index(alg)] = simple_regret
+for alg in algs:
+  regret = regret_algs[:, :, algs.index(alg)]
+  simple_regret = simple_regret_algs[:, :, algs.index(alg)]
 
   # regret plot
   plt.subplot(1, 2, 1)